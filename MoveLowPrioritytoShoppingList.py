@@ -4,27 +4,36 @@ Script to move low priority shopping list items to primary shopping list, if the
 Author:
     Protik Banerji <protik09@gmail.com>
 """
+import asyncio
+import concurrent.futures
+import hashlib
+import mmap
 import os
 import gkeepapi
 import keyring
 import maskpass
 import re
 import sys
+from typing import Optional
 try:
     import simplejson as json
 except ImportError:
     import json
-from time import perf_counter as timer, sleep
-if os.name == 'nt':
-    from infi.systray import SysTrayIcon
-else:
-    pass
-
+# orjson is optional, it is much faster at (de)serializing the notes cache.
+# json_loads() and json_dumps() work with bytes whichever library is available
 try:
-    if os.name == 'nt':
-        from infi.systray import SysTrayIcon
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
 except ImportError:
-    pass
+    def json_loads(data: bytes) -> dict:
+        """Parse JSON from a bytes-like object."""
+        return json.loads(bytes(data))
+
+    def json_dumps(obj: object) -> bytes:
+        """Serialize an object to UTF-8 encoded JSON."""
+        return json.dumps(obj).encode()
+from time import monotonic, perf_counter as timer
 # Define constants at the top of your file
 GOOGLE_KEEP_MASTER_TOKEN = 'Google Keep Master Token'
 # Define the base directory for your application
@@ -32,6 +41,18 @@ BASE_DIR = os.path.abspath(os.getcwd())
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json')
 # Adjust the path for keep_notes.json
 KEEP_NOTES_PATH = os.path.join(BASE_DIR, 'keep_notes.json')
+# Email address pattern used to validate the Google Keep username
+EMAIL_REGEX = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b')
+# Where moved items are placed in the primary list
+NEW_ITEM_PLACEMENT = gkeepapi.node.NewListItemPlacementValue.Top
+# Polling interval bounds in seconds, can be overridden by 'min_poll_interval' and 'max_poll_interval' in config.json.
+# The interval doubles on every idle sync up to the maximum
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 60.0
+# Minimum number of seconds between two writes of the notes cache, can be overridden by 'dump_interval' in config.json
+DUMP_INTERVAL = 60.0
+# Digest of the last notes cache written to disk, so unchanged dumps are not rewritten
+_last_dump_hash = None
 
 
 
@@ -82,9 +103,7 @@ def check_username(username: str) -> None:
         None
     """
     assert username != "", f"Username is empty"
-    email_regex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
-    assert re.match(
-        email_regex, username), f"Invalid email address: {'username'}"
+    assert EMAIL_REGEX.match(username), f"Invalid email address: {username}"
     return None
 
 
@@ -119,39 +138,93 @@ def check_list_names(keep: object, primary_list: list, low_priority_list: list)
     Returns:
         None
     """
-    assert primary_list != [], f"Primary list name is empty"
+    assert primary_list, f"Primary list name is empty"
     for list_name in primary_list:
         assert list_name != "", f"Invalid Primary list name: {list_name}"
-    assert low_priority_list != [], f"Low priority list name is empty"
+    assert low_priority_list, f"Low priority list name is empty"
     for list_name in low_priority_list:
         assert list_name != "", f"Invalid Low priority list name: {list_name}"
-    # Check if the list names exist in the keep object
+    # Check if the list names exist in the keep object, collecting the (non trashed) note titles in one pass
+    titles = {note.title for note in keep.find()}
     for list_name in primary_list:
-        assert keep.list(list_name) is not None, f"Primary list does not exist: {list_name}"
+        assert list_name in titles, f"Primary list does not exist: {list_name}"
     for list_name in low_priority_list:
-        assert keep.list(list_name) is not None, f"Low priority list does not exist: {list_name}"
+        assert list_name in titles, f"Low priority list does not exist: {list_name}"
     return None
 
 
-def check_low_priority_items(keep: object, low_priority_list: str) -> list:
+def index_notes_by_title(keep: object, list_titles: set) -> dict:
     """
-    Check the low priority list for items that are ticked.
+    Build a title to notes index once per sync, so each list lookup is a dict hit instead of a scan.
+    Only notes whose title is one of the configured list names are indexed, and trashed notes are skipped.
 
     Args:
         keep (obj): Google Keep object
+        list_titles (set): Names of all primary and low priority lists
+
+    Returns:
+        dict: Dictionary of note title to list of notes with that title
+    """
+    notes_by_title = {}
+    for note in keep.find(func=lambda note: note.title in list_titles):
+        notes_by_title.setdefault(note.title, []).append(note)
+    return notes_by_title
+
+
+def has_ticked_items(note: object) -> bool:
+    """
+    Check whether a list has any ticked items, stopping at the first one found.
+    Unlike note.checked this doesn't sort the items, so it is cheap on the common idle path.
+
+    Args:
+        note (obj): Google Keep list
+
+    Returns:
+        bool: 'True' if at least one item is ticked, 'False' if not.
+    """
+    return any(isinstance(node, gkeepapi.node.ListItem) and node.checked and not node.deleted
+               for node in note.children)
+
+
+def has_items_to_move(notes_by_title: dict, list_sets: list) -> bool:
+    """
+    Check whether any low priority list has ticked items waiting to be moved.
+    Sets whose primary list doesn't exist are ignored, since their items can't be moved.
+
+    Args:
+        notes_by_title (dict): Title to notes index from index_notes_by_title()
+        list_sets (list): (primary list, low priority list) name pairs
+
+    Returns:
+        bool: 'True' if at least one low priority list has a ticked item, 'False' if not.
+    """
+    return any(has_ticked_items(note)
+               for primary_list, low_priority_list in list_sets
+               if primary_list in notes_by_title
+               for note in notes_by_title.get(low_priority_list, ()))
+
+
+def check_low_priority_items(notes_by_title: dict, low_priority_list: str) -> list:
+    """
+    Check the low priority list for items that are ticked.
+
+    Args:
+        notes_by_title (dict): Title to notes index from index_notes_by_title()
         low_priority_list (str): Name of low priority list
 
     Returns:
         list: List of items to move
     """
     items_to_move = []
-    for note in keep.all():
-        if low_priority_list in note.title:
-            checked_items = note.checked
-            for item in checked_items:
-                items_to_move.append(item)
-                # delete item from note
-                item.delete()
+    for note in notes_by_title.get(low_priority_list, ()):
+        if not has_ticked_items(note):
+            continue
+        # Snapshot the ticked items, since deleting them changes what note.checked returns
+        checked_items = list(note.checked)
+        items_to_move.extend(checked_items)
+        # delete items from note
+        for item in checked_items:
+            item.delete()
     return items_to_move
 
 
@@ -169,69 +242,138 @@ def check_num_sets(num_sets: int) -> None:
     return None
 
 
-def check_settings(keep: object, config: dict) -> None:
+def check_intervals(config: dict) -> None:
+    """
+    Check that the optional polling and dump intervals are positive, and that the minimum poll interval isn't above the maximum.
+    A poll interval of 0 would never back off and sync with Google Keep without any pause.
+
+    Args:
+        config (dict): Dictionary of settings
+
+    Returns:
+        None
+    """
+    min_poll_interval = config.get('min_poll_interval', MIN_POLL_INTERVAL)
+    max_poll_interval = config.get('max_poll_interval', MAX_POLL_INTERVAL)
+    dump_interval = config.get('dump_interval', DUMP_INTERVAL)
+    for name, value in (('min_poll_interval', min_poll_interval),
+                        ('max_poll_interval', max_poll_interval),
+                        ('dump_interval', dump_interval)):
+        assert isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0, \
+            f"{name} must be a positive number of seconds, got: {value}"
+    assert min_poll_interval <= max_poll_interval, \
+        f"min_poll_interval must not be greater than max_poll_interval, got: {min_poll_interval} > {max_poll_interval}"
+    return None
+
+
+def check_settings(config: dict) -> None:
     """
     Check that the settings file is not broken.
+    This only checks the settings themselves, the list names are checked with check_list_names() after logging in.
 
     Args:
-        keep (obj): Google Keep object
         config (dict): Dictionary of settings
 
     Returns:
-        bool: 'True' if settings are valid, 'False' if not
+        None
     """
-    assert config != {}, f"{CONFIG_FILE} is empty"  # Check that config is not empty
+    assert config, f"{CONFIG_FILE} is empty"  # Check that config is not empty
     assert config['first_run_flag'] == "True", f"{CONFIG_FILE} maybe corrupted"
     check_token(config['master_token'])
     check_username(config["username"])
     check_num_sets(config['num_sets'])
-    # Check to see that there are no empty elements or empty strings in the primary and low prioritylist
-    check_list_names(keep, config['primary_list'], config['low_priority_list'])
+    check_intervals(config)
     print(f'Loaded settings. Username: {config["username"]}')
 
     return None
 
 
-def move_items_to_primary_list(keep: object, primary_list: str, items_to_move: list) -> None:
+def move_items_to_primary_list(notes_by_title: dict, primary_list: str, texts: list) -> None:
     """
     Move ticked items from low priority list to primary list.
 
     Args:
-        keep (obj): Google Keep object
+        notes_by_title (dict): Title to notes index from index_notes_by_title()
         primary_list (str): Name of primary list
-        items_to_move (list): List of items to move
+        texts (list): Text of the items to move
 
     Returns:
         None
     """
-    for note in keep.all():
-        if primary_list in note.title:
-            for item in items_to_move:
-                # Add the item to the top of the primary list unticked
-                note.add(item.text, False,
-                         gkeepapi.node.NewListItemPlacementValue.Top)
+    for note in notes_by_title.get(primary_list, ()):
+        add = note.add
+        for text in texts:
+            # Add the item to the top of the primary list unticked
+            add(text, False, NEW_ITEM_PLACEMENT)
     return None
 
-def delete_ticked_items_from_primary_list(keep: object, primary_list: str) -> None:
+def delete_ticked_items_from_primary_list(notes_by_title: dict, primary_list: str) -> None:
     """
     Delete ticked items from primary list.
     
     Args:
-        keep (obj): Google Keep object
+        notes_by_title (dict): Title to notes index from index_notes_by_title()
         primary_list (str): Name of primary list
         
     Returns:
         None
     """
-    for note in keep.all():
-        if primary_list in note.title:
-            for item in note:
-                if item.checked:
-                    item.delete()
+    for note in notes_by_title.get(primary_list, ()):
+        if not has_ticked_items(note):
+            continue
+        # Snapshot the ticked items before deleting any, so the list isn't changed while being iterated
+        ticked_items = list(note.checked)
+        for item in ticked_items:
+            item.delete()
                     
     return None
 
-def loop(keep: object, config: dict) -> None:
+def load_keep_notes() -> Optional[dict]:
+    """
+    Load the Keep Notes cache from disk.
+    The file is memory mapped, and parsed straight from the mapping when orjson is available.
+
+    Returns:
+        dict: Serialized Keep state, or None if there is no usable cache
+    """
+    try:
+        with open(KEEP_NOTES_PATH, 'rb') as infile:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                with memoryview(buffer) as view:
+                    return json_loads(view)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        # Empty or corrupted cache, fall back to a full sync from the server
+        print(f"Ignoring unreadable {KEEP_NOTES_PATH}: {e}")
+        return None
+
+
+def save_keep_notes(keep: object) -> None:
+    """
+    Dump Keep Notes to disk for caching, skipping the write if nothing changed since the last dump.
+    The cache is written to a temporary file first and then swapped in, so a crash can't leave a torn file.
+
+    Args:
+        keep (obj): Google Keep object
+
+    Returns:
+        None
+    """
+    global _last_dump_hash
+    payload = json_dumps(keep.dump())
+    dump_hash = hashlib.blake2b(payload, digest_size=16).digest()
+    if dump_hash == _last_dump_hash:
+        return None
+    temp_path = KEEP_NOTES_PATH + '.tmp'
+    with open(temp_path, 'wb') as outfile:
+        outfile.write(payload)
+    os.replace(temp_path, KEEP_NOTES_PATH)
+    _last_dump_hash = dump_hash
+    return None
+
+
+async def loop(keep: object, config: dict) -> None:
     """
         Synchronize the changes to the Google Keep server and continuously move low priority items to the primary list.
 
@@ -242,27 +384,112 @@ def loop(keep: object, config: dict) -> None:
         Returns:
             None
     """
-    while True:
-        # Syc the changes to the Google Keep server
-        keep.sync()
-        items_to_move = check_low_priority_items(
-            keep, config['low_priority_list'])
-
-        # if no items to move, return to check for low priority items
-        if items_to_move == []:
-            # print('No items to move')
-            pass
-        else:
-            move_items_to_primary_list(
-                keep, config['primary_list'], items_to_move)
-            print(
-                f'Moved {len(items_to_move)} items to {config["primary_list"]}')
-            items_to_move = []
-            # Dump Keep Notes to disk for caching
-            with open("keep_notes.json", "w") as outfile:
-                json.dump(keep.dump(), outfile)
-        # Rate restriction to prevent API ban from Google
-        sleep(0.5)
+    # Each set pairs a primary list with its low priority list
+    list_sets = list(zip(config['primary_list'], config['low_priority_list']))
+    list_titles = set(config['primary_list']) | set(config['low_priority_list'])
+    dump_interval = config.get('dump_interval', DUMP_INTERVAL)
+    min_poll_interval = config.get('min_poll_interval', MIN_POLL_INTERVAL)
+    max_poll_interval = config.get('max_poll_interval', MAX_POLL_INTERVAL)
+    poll_interval = min_poll_interval
+    last_dump = monotonic()
+    dump_pending = False
+    # The sync runs on an executor owned by the loop rather than as an asyncio task. Shutting down asyncio.run()
+    # (e.g. on Ctrl+C) cancels every task, which would let the exit path below stop waiting while the thread still syncs
+    sync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    sync_future = None
+    try:
+        # main() has just synced, so each cycle works on the notes pulled by the previous sync.
+        # Index the notes once per sync instead of scanning every note per list
+        notes_by_title = index_notes_by_title(keep, list_titles)
+        while True:
+            # Collect the ticked items of every set first, grouped by the primary list they go to
+            texts_by_primary_list = {}
+            for primary_list, low_priority_list in list_sets:
+                # Leave the ticked items where they are if there's nowhere to move them, e.g. the primary list was
+                # renamed or trashed, as they would otherwise be deleted without being added anywhere
+                if primary_list not in notes_by_title:
+                    if any(has_ticked_items(note) for note in notes_by_title.get(low_priority_list, ())):
+                        print(f'Primary list does not exist: {primary_list}, '
+                              f'not moving ticked items from {low_priority_list}')
+                    continue
+                items_to_move = check_low_priority_items(
+                    notes_by_title, low_priority_list)
+
+                # if no items to move, return to check for low priority items
+                if not items_to_move:
+                    continue
+                texts_by_primary_list.setdefault(primary_list, []).extend(
+                    item.text for item in items_to_move)
+            for primary_list, texts in texts_by_primary_list.items():
+                # Add each item only once, even if it was ticked in several low priority lists
+                texts = list(dict.fromkeys(texts))
+                move_items_to_primary_list(notes_by_title, primary_list, texts)
+                print(f'Moved {len(texts)} items to {primary_list}')
+            moved_items = bool(texts_by_primary_list)
+            # Mark the moves for dumping before syncing, so they are still flushed if the loop is stopped mid-sync
+            dump_pending = dump_pending or moved_items
+            # Syc the changes to the Google Keep server, once per cycle: this pushes all the moves staged above
+            # in one batch and pulls the latest notes for the next cycle. It is a blocking HTTP call, so it runs
+            # in a worker thread to keep the event loop free while waiting on the network.
+            # The thread can't be cancelled, so it is shielded and waited for on exit instead
+            sync_future = sync_executor.submit(keep.sync)
+            await asyncio.shield(asyncio.wrap_future(sync_future))
+            notes_by_title = index_notes_by_title(keep, list_titles)
+            # The cache only speeds up startup, so dump it at most once per dump interval
+            if dump_pending and monotonic() - last_dump >= dump_interval:
+                save_keep_notes(keep)
+                last_dump = monotonic()
+                dump_pending = False
+            # Back off while the lists are idle, and poll quickly again as soon as something moves.
+            # This also acts as rate restriction to prevent API ban from Google
+            # Items ticked since the last sync are only moved next cycle, so don't make them wait out a long interval
+            if moved_items or has_items_to_move(notes_by_title, list_sets):
+                poll_interval = min_poll_interval
+            else:
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+            await asyncio.sleep(poll_interval)
+    finally:
+        # Let a sync that was interrupted finish first, as keep.dump() must not run while keep.sync() changes the notes
+        if sync_future is not None:
+            concurrent.futures.wait([sync_future])
+        sync_executor.shutdown()
+        # Don't lose the changes made since the last dump when exiting, e.g. on Ctrl+C
+        if dump_pending:
+            save_keep_notes(keep)
+
+
+async def run(keep: object, config: dict) -> None:
+    """
+    Run the polling loop as a task, with the systray icon on Windows able to stop it.
+
+    Args:
+        keep (object): The object representing the Google Keep instance.
+        config (dict): The dictionary containing the configuration settings.
+
+    Returns:
+        None
+    """
+    loop_task = asyncio.create_task(loop(keep, config))
+    # Start SysTray Icon if running on Windows, do nothing if on Linux
+    if os.name == 'nt':
+        # Only imported here, so loading the module never pulls in the Windows-only systray
+        from infi.systray import SysTrayIcon
+        event_loop = asyncio.get_running_loop()
+        hover_text = "Move Low Priority Items to Primary List in Google Keep"
+        # The systray runs in its own thread, so Quit has to hand the cancellation over to the event loop
+        sysTrayIcon = SysTrayIcon("keep_notes_automation.ico", hover_text,
+                                  default_menu_index=1,
+                                  on_quit=lambda systray: event_loop.call_soon_threadsafe(loop_task.cancel))
+        sysTrayIcon.start()
+    try:
+        # asyncio.wait() doesn't raise when the loop is cancelled from the systray, which is a normal exit
+        await asyncio.wait([loop_task])
+    finally:
+        if os.name == 'nt':
+            sysTrayIcon.shutdown()
+    if not loop_task.cancelled():
+        # Re-raise whatever stopped the polling loop
+        loop_task.result()
 
 
 def main():
@@ -282,7 +509,7 @@ def main():
             print(f"Username or master token is invalid: {e}")
             sys.exit(-1)
         # If the login above is successful, write the master token to system keyring
-        keyring.set_password("Google Keep Master Token",
+        keyring.set_password(GOOGLE_KEEP_MASTER_TOKEN,
                              username, master_token)
         num_sets = int(
             input('Number of Sets of Lists (1 Set contains two Lists ): '))
@@ -295,55 +522,50 @@ def main():
             low_priority_list = input(f'Name of Low Priority List {i+1}: ')
             primary_lists.append(primary_list)
             low_priority_lists.append(low_priority_list)
-            check_list_names(primary_lists, low_priority_lists)
-            # Master token is stored on the system keyring so deliberately empty
-            config = {
-                "first_run_flag": "True",
-                "username": username,
-                "master_token": "",
-                "num_sets": num_sets,
-                "primary_list": primary_lists,
-                "low_priority_list": low_priority_lists
-            }
-            json_object = json.dumps(config, indent=4)
-
-            # Writing config.json
-            with open("config.json", "w") as outfile:
-                outfile.write(json_object)
-            config["master_token"] = master_token
-
-        # Before loading the Google Keep object check the settings
-        if check_settings(keep, config):
-            pass
-        else:
-            raise Exception("Settings are not valid")
+        # Validate the list names once, after all of them have been entered
+        check_list_names(keep, primary_lists, low_priority_lists)
+        # Master token is stored on the system keyring so deliberately empty
+        config = {
+            "first_run_flag": "True",
+            "username": username,
+            "master_token": "",
+            "num_sets": num_sets,
+            "primary_list": primary_lists,
+            "low_priority_list": low_priority_lists
+        }
+        json_object = json.dumps(config, indent=4)
+
+        # Writing config.json
+        with open(CONFIG_FILE, "w") as outfile:
+            outfile.write(json_object)
+        config["master_token"] = master_token
+        # Every setting was already validated as it was entered, so check_settings() isn't needed here
+        # The login sync happened before the prompts above, which can take a while to answer. Sync again so the
+        # first cycle of loop() doesn't act on ticks that have since been undone in the Keep app
+        keep.sync()
 
         # Dump Keep Notes to disk for caching
-        with open("keep_notes.json", "w") as outfile:
-            json.dump(keep.dump(), outfile)
+        save_keep_notes(keep)
 
     else:
         config = load_settings()
+        # Check the settings before logging in, so a broken config.json isn't reported as a login failure
         check_settings(config)
-        # Restore notes from database or online
-        keep.resume(config['username'], config['master_token'],
-                    state=json.load(open("keep_notes.json")))
+        # Restore notes from the local cache if there is one, so a single login is needed either way
+        state = load_keep_notes()
+        try:
+            keep = gkeepapi.Keep()
+            keep.resume(config['username'], config['master_token'], state=state)
+        except Exception as e:
+            print(f"Username or master token is invalid: {e}")
+            sys.exit(-1)
+        # Check to see that there are no empty elements or empty strings in the primary and low prioritylist
+        check_list_names(keep, config['primary_list'], config['low_priority_list'])
 
     # end_time = timer()
     # print(f'Time to initialize: {(end_time - start_time)}s')
 
-    # Start SysTray Icon if running on Windows, do nothing if on Linux
-    if os.name == 'nt':
-        hover_text = "Move Low Priority Items to Primary List in Google Keep"
-        sysTrayIcon = SysTrayIcon("keep_notes_automation.ico", hover_text,
-                                  default_menu_index=1)
-        try:
-            sysTrayIcon.start()
-        except KeyboardInterrupt:
-            sysTrayIcon.shutdown()
-    else:
-        pass
-    loop(keep, config)
+    asyncio.run(run(keep, config))
 
 
 if __name__ == '__main__':